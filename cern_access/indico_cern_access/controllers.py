@@ -7,6 +7,7 @@
 
 from collections import Counter
 from datetime import timedelta
+from hmac import compare_digest
 
 from flask import current_app, jsonify, redirect, render_template, request
 from flask_pluginengine import current_plugin, render_plugin_template
@@ -217,7 +218,10 @@ class RHStatsAPI(RH):
         auth = request.authorization
         username = CERNAccessPlugin.settings.get('api_username')
         password = CERNAccessPlugin.settings.get('api_password')
-        if not auth or not auth.password or auth.username != username or auth.password != password:
+        # compare bytes; compare_digest rejects non-ascii strings
+        if (not auth or not auth.password
+                or not compare_digest((auth.username or '').encode(), username.encode())
+                or not compare_digest(auth.password.encode(), password.encode())):
             response = current_app.response_class('Authorization required', 401,
                                                   {'WWW-Authenticate': 'Basic realm="Indico - CERN Access Stats"'})
             raise Unauthorized(response=response)
@@ -0,0 +1,40 @@
+# This file is part of the CERN Indico plugins.
+# Copyright (C) 2014 - 2022 CERN
+#
+# The CERN Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License; see
+# the LICENSE file for more details.
+
+from base64 import b64encode
+
+import pytest
+from werkzeug.exceptions import Unauthorized
+
+from indico_cern_access.controllers import RHStatsAPI
+from indico_cern_access.plugin import CERNAccessPlugin
+
+
+@pytest.mark.usefixtures('db')
+@pytest.mark.parametrize(('username', 'password', 'expected'), [
+    ('statsuser', 'statspass', True),
+    ('statsuser', 'wrongpass', False),
+    ('wronguser', 'statspass', False),
+    # non-ascii credentials must fail cleanly, not crash the comparison
+    ('statsuser', 'statsp\xe4ss', False),
+    ('st\xe4tsuser', 'statspass', False),
+    ('', '', False),
+    (None, None, False),
+])
+def test_stats_api_check_access(app, username, password, expected):
+    CERNAccessPlugin.settings.set_multi({'api_username': 'statsuser', 'api_password': 'statspass'})
+    headers = {}
+    if username is not None:
+        credentials = b64encode(f'{username}:{password}'.encode()).decode()
+        headers['Authorization'] = f'Basic {credentials}'
+    with app.test_request_context(headers=headers):
+        rh = RHStatsAPI()
+        if expected:
+            rh._check_access()
+        else:
+            with pytest.raises(Unauthorized):
+                rh._check_access()
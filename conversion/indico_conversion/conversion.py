@@ -7,11 +7,16 @@
 
 import os
 from datetime import timedelta
+from functools import lru_cache
+from http.client import HTTPConnection
 
 import requests
 from celery.exceptions import MaxRetriesExceededError, Retry
 from flask import jsonify, request, session
-from itsdangerous import BadData
+from itsdangerous import BadData, URLSafeTimedSerializer
+from requests.adapters import HTTPAdapter
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from sqlalchemy.orm import joinedload, load_only
 
 from indico.core import signals
 from indico.core.celery import celery
@@ -20,7 +25,6 @@ from indico.core.db import db
 from indico.core.plugins import url_for_plugin
 from indico.modules.attachments.models.attachments import Attachment, AttachmentFile, AttachmentType
 from indico.util.fs import secure_filename
-from indico.util.signing import secure_serializer
 from indico.web.flask.templating import get_template_module
 from indico.web.rh import RH
 
@@ -29,51 +33,107 @@ from indico_conversion.util import get_pdf_title
 
 
 MAX_TRIES = 20
-DELAYS = [30, 60, 120, 300, 600, 1800, 3600, 3600, 7200]
+DELAYS = (30, 60, 120, 300, 600, 1800, 3600, 3600, 7200)
+
+# reuse keep-alive connections to the conversion server instead of doing a
+# new TCP+TLS handshake for every submission; celery workers are long-lived
+# so the pool stays warm across tasks
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+_session.mount('https://', _adapter)
+_session.mount('http://', _adapter)
+
+# requests does not expose http.client's blocksize, and the default 8 KiB
+# send buffer makes uploads of multi-MB files needlessly slow
+HTTPConnection.__init__.__defaults__ = tuple(65536 if x == 8192 else x
+                                             for x in HTTPConnection.__init__.__defaults__)
+
+
+@lru_cache(maxsize=1)
+def _get_pdf_serializer():
+    """Return a serializer pre-bound to the pdf-conversion salt.
+
+    itsdangerous derives the salted signing key anew on every
+    ``dumps``/``loads`` call with an explicit salt; the salt never changes
+    here so the signer is built once.  Lazy because the secret key is not
+    available at import time.  Timed like ``secure_serializer`` so tokens
+    signed before this serializer existed still verify.
+    """
+    return URLSafeTimedSerializer(config.SECRET_KEY, salt='pdf-conversion')
+
+
+@lru_cache(maxsize=1)
+def _is_debug():
+    # config.DEBUG goes through the lazy config proxy on every access;
+    # workers never change it mid-run so look it up once
+    return config.DEBUG
+
+
+@lru_cache(maxsize=256)
+def _get_signed_payload(attachment_id, title):
+    """Return the signed payload for an attachment.
+
+    It depends only on the attachment id and pdf title, so it is cached
+    per worker to avoid re-signing (HMAC) the same payload on every retry.
+    """
+    return _get_pdf_serializer().dumps({'attachment_id': attachment_id, 'title': title})
+
+
+def get_submit_filename(attachment):
+    """Return the sanitized filename to submit for an attachment."""
+    name, ext = os.path.splitext(attachment.file.filename)
+    # we know ext is safe since it's based on a whitelist. the name part may be fully
+    # non-ascii so we sanitize that to a generic name if necessary
+    return secure_filename(name, 'attachment') + ext
 
 
 @celery.task(bind=True, max_retries=None)
-def submit_attachment(task, attachment):
+def submit_attachment(task, attachment_id, filename):
     """Sends an attachment's file to the conversion service"""
     from indico_conversion.plugin import ConversionPlugin
     if ConversionPlugin.settings.get('maintenance'):
         task.retry(countdown=900)
+    attachment = Attachment.get(attachment_id)
+    if attachment is None or attachment.is_deleted or attachment.folder.is_deleted:
+        ConversionPlugin.logger.info('Attachment %d has been deleted; not submitting it', attachment_id)
+        return
     url = ConversionPlugin.settings.get('server_url')
-    payload = {
-        'attachment_id': attachment.id
-    }
+    file = attachment.file
+    dirresponse = _get_signed_payload(attachment_id, get_pdf_title(attachment))
     data = {
         'converter': 'pdf',
         'urlresponse': url_for_plugin('conversion.callback', _external=True),
-        'dirresponse': secure_serializer.dumps(payload, salt='pdf-conversion')
+        'dirresponse': dirresponse
     }
-    file = attachment.file
-    name, ext = os.path.splitext(file.filename)
-    # we know ext is safe since it's based on a whitelist. the name part may be fully
-    # non-ascii so we sanitize that to a generic name if necessary
-    filename = secure_filename(name, 'attachment') + ext
     with file.open() as fd:
         try:
-            response = requests.post(url, data=data, files={'uploadedfile': (filename, fd, file.content_type)})
-            response.raise_for_status()
-            if 'ok' not in response.text:
-                raise requests.RequestException(f'Unexpected response from server: {response.text}')
+            # stream the upload in chunks instead of letting requests buffer
+            # the whole multipart body in memory
+            encoder = MultipartEncoder(fields={**data, 'uploadedfile': (filename, fd, file.content_type)})
+            response = _session.post(url, data=encoder, headers={'Content-Type': encoder.content_type},
+                                     stream=True, timeout=(5, 120))
+            try:
+                response.raise_for_status()
+                # the server replies with a tiny 'ok'; read only a bounded chunk
+                # so a misbehaving server cannot make us buffer a huge body
+                body = next(response.iter_content(64), b'')
+                if b'ok' not in body:
+                    raise requests.RequestException(f'Unexpected response from server: {body}')
+            finally:
+                response.close()
         except requests.RequestException as exc:
             attempt = task.request.retries + 1
-            try:
-                delay = DELAYS[task.request.retries] if not config.DEBUG else 1
-            except IndexError:
-                # like this we can safely bump MAX_TRIES manually if necessary
-                delay = DELAYS[-1]
+            # clamping the index lets us safely bump MAX_TRIES manually if necessary
+            delay = 1 if _is_debug() else DELAYS[min(task.request.retries, len(DELAYS) - 1)]
             try:
                 task.retry(countdown=delay, max_retries=(MAX_TRIES - 1))
             except MaxRetriesExceededError:
                 ConversionPlugin.logger.error('Could not submit attachment %d (attempt %d/%d); giving up [%s]',
-                                              attachment.id, attempt, MAX_TRIES, exc)
-                pdf_state_cache.delete(str(attachment.id))
+                                              attachment_id, attempt, MAX_TRIES, exc)
+                pdf_state_cache.delete(str(attachment_id))
             except Retry:
                 ConversionPlugin.logger.warning('Could not submit attachment %d (attempt %d/%d); retry in %ds [%s]',
-                                                attachment.id, attempt, MAX_TRIES, delay, exc)
+                                                attachment_id, attempt, MAX_TRIES, delay, exc)
                 raise
         else:
             ConversionPlugin.logger.info('Submitted %r', attachment)
@@ -87,7 +147,7 @@ class RHConversionFinished(RH):
     def _process(self):
         from indico_conversion.plugin import ConversionPlugin
         try:
-            payload = secure_serializer.loads(request.form['directory'], salt='pdf-conversion')
+            payload = _get_pdf_serializer().loads(request.form['directory'])
         except BadData:
             ConversionPlugin.logger.exception('Received invalid payload (%s)', request.form['directory'])
             return jsonify(success=False)
@@ -99,14 +159,17 @@ class RHConversionFinished(RH):
             ConversionPlugin.logger.error('Received invalid status %s for %s', request.form['status'], attachment)
             return jsonify(success=False)
         name, ext = os.path.splitext(attachment.file.filename)
-        title = get_pdf_title(attachment)
+        # payloads signed before the title was included lack it; fall back
+        # to computing it for conversions that were in flight during an upgrade
+        title = payload.get('title') or get_pdf_title(attachment)
         pdf_attachment = Attachment(folder=attachment.folder, user=attachment.user, title=title,
                                     description=attachment.description, type=AttachmentType.file,
                                     protection_mode=attachment.protection_mode, acl=attachment.acl)
-        data = request.files['content'].stream.read()
         pdf_attachment.file = AttachmentFile(user=attachment.file.user, filename=f'{name}.pdf',
                                              content_type='application/pdf')
-        pdf_attachment.file.save(data)
+        # pass the stream so the storage backend copies it in chunks instead
+        # of the whole pdf being read into memory first
+        pdf_attachment.file.save(request.files['content'].stream)
         db.session.add(pdf_attachment)
         db.session.flush()
         pdf_state_cache.set(str(attachment.id), 'finished', timeout=timedelta(minutes=15))
@@ -120,14 +183,31 @@ class RHConversionCheck(RH):
 
     def _process(self):
         ids = request.args.getlist('a')
-        results = {int(id_): pdf_state_cache.get(id_) for id_ in ids}
-        finished = [id_ for id_, status in results.items() if status == 'finished']
-        pending = [id_ for id_, status in results.items() if status == 'pending']
+        # a single `get_many` results in one MGET instead of one GET per id on redis
+        statuses = pdf_state_cache.get_many(*ids) if ids else []
+        finished = []
+        pending = []
+        for id_, status in zip(ids, statuses):
+            if status == 'finished':
+                finished.append(int(id_))
+            elif status == 'pending':
+                pending.append(int(id_))
         containers = {}
         if finished:
             tpl = get_template_module('attachments/_display.html')
-            for attachment in Attachment.query.filter(Attachment.id.in_(finished)):
-                if not attachment.folder.can_view(session.user):
-                    continue
-                containers[attachment.id] = tpl.render_attachments_folders(item=attachment.folder.object)
+            # only the id and the folder are used below, so skip the other columns
+            query = (Attachment.query
+                     .filter(Attachment.id.in_(finished))
+                     .options(load_only('id', 'folder_id'),
+                              joinedload('folder').selectinload('acl_entries')))
+            # attachments uploaded together usually share a folder; render each
+            # folder only once and reuse the markup for all its attachments
+            by_folder = {}
+            for attachment in query:
+                if attachment.folder.can_view(session.user):
+                    by_folder.setdefault(attachment.folder, []).append(attachment.id)
+            for folder, attachment_ids in by_folder.items():
+                html = tpl.render_attachments_folders(item=folder.object)
+                for id_ in attachment_ids:
+                    containers[id_] = html
         return jsonify(finished=finished, pending=pending, containers=containers)
@@ -25,7 +25,7 @@ from indico.web.forms.widgets import SwitchWidget
 
 from indico_conversion import _, pdf_state_cache
 from indico_conversion.blueprint import blueprint
-from indico_conversion.conversion import submit_attachment
+from indico_conversion.conversion import get_submit_filename, submit_attachment
 from indico_conversion.util import get_pdf_title
 
 
@@ -111,7 +111,7 @@ class ConversionPlugin(IndicoPlugin):
 
     def _after_commit(self, sender, **kwargs):
         for attachment in g.get('convert_attachments', ()):
-            submit_attachment.delay(attachment)
+            submit_attachment.delay(attachment.id, get_submit_filename(attachment))
 
     def _event_display_after_attachment(self, attachment, top_level, has_label, **kwargs):
         if attachment.type != AttachmentType.file: